@@ -1,8 +1,8 @@
-import os, shutil, glob, re
+import os, shutil, glob, re, ctypes, mmap
 import numpy as np
 import pandas as pd
-from scipy.optimize import curve_fit
 from subprocess import Popen
+from concurrent.futures import ThreadPoolExecutor
 
 '''
 In the paper Empirical correction for resolution- and temperature-
@@ -37,7 +37,7 @@ written to the .hkl and the line: !TDS CORRECTION FACTOR: a=x.xxx,
 b=x.xxx is added and should remain there for later reference! XD will
 correctly ignore the line. The XD path, number of scale factors and
 number of cycles are of course hardcoded and have to be changed by
-editing the .py file directly.
+editing the .py file directly (or passed to main() when importing it).
 
 The small note
 The program needs the initial .hkl file to have 6 columns, that should
@@ -56,106 +56,197 @@ sf_num = 12
 max_cycles = 2
 ext_to_save = ['hkl','fco','res','inp','fou','mas']
 
-# polynomial to fit
-def func(x,a,b):
-    return 1+(a*x**2+b*x**3)
+# USAGE line in .inp (6th entry: number of scalefactors)
+re_usage = re.compile(r'(USAGE(?:\s+\d+){5})\s+(?:\d+)((?:\s+\d+){8})')
+# scalefactor line in .inp
+re_sfac_line = re.compile(r'^(\s+\d+\.\d+E[-+]\d[1-9])$', re.MULTILINE)
+# scalefactors to refine in .mas
+re_scale = re.compile(r'(SCALE\s+)(\d)+')
+# scalefactor in .res
+re_sfac = re.compile(rb'\d+\.\d+E[-+]\d\d')
+
+# polynomial to fit: 1 + a*x² + b*x³
+# it is linear in a and b -> solve it directly as least squares
+def fit_poly(x, y):
+    x2 = x*x
+    A = np.column_stack([x2, x2*x])
+    popt, *_ = np.linalg.lstsq(A, y - 1.0, rcond=None)
+    return popt
+
+def copy_file(src, dst):
+    # data only, no permission bits
+    if os.name == 'nt':
+        # native win32 copy, python would fall back to a read/write loop
+        if not ctypes.windll.kernel32.CopyFileW(src, dst, False):
+            raise ctypes.WinError()
+    else:
+        shutil.copyfile(src, dst)
 
 def save_copies(ext_to_save, num):
-    for ext in ext_to_save:
-        fname = f"xd.{ext}"
-        if os.path.exists(fname):
-            shutil.copy(fname, f"xd{num}.{ext}")
+    # the files are independent, copy them concurrently
+    with ThreadPoolExecutor(max_workers=len(ext_to_save)) as ex:
+        jobs = [ex.submit(copy_file, f"xd.{ext}", f"xd{num}.{ext}")
+                for ext in ext_to_save if os.path.exists(f"xd.{ext}")]
+    # raise if a copy failed
+    for job in jobs:
+        job.result()
 
-# do it
-def main():
-    # get the next available number
-    num = f"{len(glob.glob('xd??.hkl')):>02}"
+def apply_correction(df, a, b):
+    # divide F2o by 1 + a*stl² + b*stl³ in place, single temporary
+    stl = df['stl'].to_numpy()
+    corr = np.multiply(stl, b)
+    corr += a
+    corr *= stl
+    corr *= stl
+    corr += 1.0
+    df['hkl_F2o'] /= corr
+
+def parse_sfacs(fname, num):
+    # map the .res instead of reading it, the scalefactors are the last
+    # numbers in it: only search a tail (starting at a line) and widen
+    # it until all num are found
+    with open(fname, 'rb') as of, \
+         mmap.mmap(of.fileno(), 0, access=mmap.ACCESS_READ) as rf:
+        size = 1024
+        while True:
+            start = rf.rfind(b'\n', 0, max(len(rf)-size, 0)) + 1
+            found = re_sfac.findall(rf, start)
+            if len(found) >= num or start == 0:
+                return np.array([float(i) for i in found[-num:]])
+            size *= 4
+
+def read_fco(fname):
+    # read fco data (C parser, whitespace separated)
+    return pd.read_csv(fname, sep=r'\s+', engine='c', header=None,
+                       skiprows=26, usecols=[0,1,2,6,7],
+                       names=['h','k','l','stl','xdr'],
+                       dtype={'h':np.int32, 'k':np.int32, 'l':np.int32,
+                              'stl':np.float64, 'xdr':np.int32})
+
+def read_hkl(fname):
+    # read hkl header and data, '!' lines are comments
+    with open(fname) as of:
+        header = of.readline()
+        df_hkl = pd.read_csv(of, sep=r'\s+', engine='c', header=None,
+                             comment='!', usecols=[0,1,2,3,4,5],
+                             names=['h','k','l','bn','hkl_F2o','hkl_F2s'],
+                             dtype={'h':np.int32, 'k':np.int32,
+                                    'l':np.int32, 'bn':np.int32,
+                                    'hkl_F2o':np.float64,
+                                    'hkl_F2s':np.float64})
+    return header, df_hkl
+
+def read_data(fname_fco, fname_hkl):
+    # read fco data
+    df = read_fco(fname_fco)
+    # reject unused
+    df = df[df['xdr'].to_numpy() == 0].drop(columns='xdr')
     
+    # read hkl header and data
+    header, df_hkl = read_hkl(fname_hkl)
+    
+    # merge hkl and fco data (to get sintl)
+    df_hkl = df_hkl.drop(['h','k','l'], axis=1).set_index(hkl_key(df_hkl))
+    df = df.join(df_hkl, on=hkl_key(df), how='inner')
+    return header, df
+
+def hkl_key(df):
+    # pack h, k, l (|index| < 512) into a single integer key
+    h, k, l = (df[c].to_numpy() + 512 for c in 'hkl')
+    return (h << 20) | (k << 10) | l
+
+def write_hkl(fname, header, df, decimals=6, corr_fact=None):
+    # hkl header and correction factor
+    out = [header]
+    if corr_fact is not None:
+        out.append(f'!TDS CORRECTION FACTOR: a={corr_fact[0]:.3f}, '
+                   f'b={corr_fact[1]:.3f}\n')
+    # batch number column is as wide as the largest one
+    wbn = len(str(df['bn'].max()))
+    fmt = f'%4d %3d %3d %{wbn}d %12.{decimals}f %12.{decimals}f\n'
+    # format all rows (as python scalars) and write it in one go
+    rows = zip(*(df[c].to_numpy().tolist()
+                 for c in ['h','k','l','bn','hkl_F2o','hkl_F2s']))
+    out.extend(fmt % row for row in rows)
+    with open(fname, 'w') as wf:
+        wf.write(''.join(out))
+
+def patch_lines(fname, *subs):
+    # stream the file line by line and apply the (regex, repl) pairs,
+    # then swap the patched copy in
+    with open(fname) as of, open(f"{fname}.tmp", 'w') as wf:
+        for line in of:
+            for regex, repl in subs:
+                line = regex.sub(repl, line)
+            wf.write(line)
+    os.replace(f"{fname}.tmp", fname)
+
+def file_sig(fname):
+    # modification time and size, used to detect outside changes
+    st = os.stat(fname)
+    return st.st_mtime_ns, st.st_size
+
+def run_xdlsm(path_xdlsm, *info):
     # print an info header
     print(f"\n {'>':>^66}")
-    print(f" >>> {f'Initital 1 Scalefactor Refinement':^58} >>>")
+    for line in info:
+        print(f" >>> {line:^58} >>>")
     # run xdlsm
     p = Popen(path_xdlsm)
     p.wait()
+
+# do it
+def main(path_xdlsm=path_xdlsm, sf_num=sf_num, max_cycles=max_cycles,
+         ext_to_save=ext_to_save):
+    # background worker to save copies while we keep going
+    pool = ThreadPoolExecutor(max_workers=1)
     
-    # save copies
-    save_copies(ext_to_save, num)
-    
-    # read fco data
-    df = pd.DataFrame(np.loadtxt(f"xd.fco", skiprows=26,
-                                 usecols=(0,1,2,3,4,6,7)),
-                      columns=['h','k','l','F2c','F2o','stl','xdr'],
-                      dtype=np.float)
+    # get the next available number
+    num = f"{len(glob.glob('xd??.hkl')):>02}"
     
-    # reject unused
-    df.query("xdr == 0", inplace=True)
-    df.drop(['xdr'], axis=1, inplace=True)
+    # run xdlsm
+    run_xdlsm(path_xdlsm, 'Initital 1 Scalefactor Refinement')
     
-    # read hkl header and data
-    with open(f"xd.hkl") as of:
-        header = of.readline()
-        df_hkl = pd.DataFrame(np.loadtxt(of, usecols=(0,1,2,3,4,5),
-                                         comments='!'),
-                              columns=['h','k','l','bn','hkl_F2o',
-                                       'hkl_F2s'],
-                              dtype=np.float)
+    # save copies (in the background)
+    copies = pool.submit(save_copies, ext_to_save, num)
     
-    # merge hkl and fco data (to get sintl)
-    df = pd.merge(df, df_hkl, on=['h','k','l'])
-    # set types
-    df[['h','k','l','bn']] = df[['h','k','l','bn']].astype(np.int8)
+    # read and merge fco and hkl data
+    header, df = read_data(f"xd.fco", f"xd.hkl")
     
-    # bin it
-    binned, bins = pd.cut(df['stl'], sf_num, retbins=True)
+    # bin it (equal width)
+    stl = df['stl'].to_numpy()
+    bins = np.linspace(stl.min(), stl.max(), sf_num+1)
+    # batch number = bin number
+    df['bn'] = (np.searchsorted(bins[1:-1], stl, side='left')
+                + 1).astype(np.int32)
     # calculate the centers of the bins
     bins = (bins[1:]+bins[:-1])/2
-    # batch number = bin number
-    df['bn'] = df.groupby(binned)['bn'].ngroup() + 1
     
-    # write new hkl
-    with open(f"xd.hkl", 'w') as wf:
-        wf.write(header)
-        df.drop(['F2c','F2o','stl'], axis=1, inplace=True)
-        df.to_string(wf, index=False, header=False,
-                     columns=['h','k','l','bn','hkl_F2o','hkl_F2s'],
-                     formatters=['{:4.0f}'.format,'{:3.0f}'.format,
-                                 '{:3.0f}'.format,'{:1.0f}'.format,
-                                 '{:12.3f}'.format,'{:12.3f}'.format])
+    # write new hkl (the copies have to be done)
+    copies.result()
+    write_hkl(f"xd.hkl", header, df, decimals=3)
+    hkl_sig = file_sig(f"xd.hkl")
     
     # edit xd input
-    with open(f"xd.inp") as of:
-        rf = of.read()
-    # update the USAGE line
-    rf = re.sub('(USAGE(?:\s+\d+){5})\s+(?:\d+)((?:\s+\d+){8})',
-                f"\g<1>{sf_num:4}\g<2>", rf)
-    # add the scalefactor starting values
-    rf = re.sub('^(\s+\d+\.\d+E(?:\-|\+)\d[1-9])$',
-                ('\g<1>'*6+'\n')*(sf_num//6)+'\g<1>'*(sf_num%6),
-                rf, flags=re.MULTILINE)
-    # write new .inp
-    with open(f"xd.inp", 'w') as wf:
-        wf.write(rf)
+    patch_lines(f"xd.inp",
+                # update the USAGE line
+                (re_usage, rf"\g<1>{sf_num:4}\g<2>"),
+                # add the scalefactor starting values
+                (re_sfac_line, (r'\g<1>'*6+'\n')*(sf_num//6)
+                               + r'\g<1>'*(sf_num%6)))
     
     # edit xd master
-    with open(f"xd.mas") as of:
-        rf = of.read()
-    # add the scalefactors to be refined
-    rf = re.sub('(SCALE\s+)(\d)+', '\g<1>'+'1'*sf_num, rf)
-    # write new .mas
-    with open(f"xd.mas", 'w') as wf:
-        wf.write(rf)
+    patch_lines(f"xd.mas",
+                # add the scalefactors to be refined
+                (re_scale, r'\g<1>'+'1'*sf_num))
     
-    # print an info header
-    print(f"\n {'>':>^66}")
-    print(f" >>> {f'{sf_num:>2} Scalefactor Refinement':^58} >>>")
     # run xdlsm
-    p = Popen(path_xdlsm)
-    p.wait()
+    run_xdlsm(path_xdlsm, f'{sf_num:>2} Scalefactor Refinement')
     
     # get the next available number
     num = f"{len(glob.glob('xd??.hkl')):>02}"
-    # save copies
-    save_copies(ext_to_save, num)
+    # save copies (in the background)
+    copies = pool.submit(save_copies, ext_to_save, num)
     
     #############################
     ## iterate it (if needed!) ##
@@ -164,12 +255,8 @@ def main():
     corr_fact = np.array([0.0,0.0])
     for _ in range(max_cycles):
         
-        # read xd result
-        with open(f"xd.res") as of:
-            rf = of.read()
         # parse new scalefactors from .res
-        sfacs = np.array(re.findall('(\d+\.\d+E(?:\-|\+)\d\d)', rf,
-                         flags=re.MULTILINE)[-sf_num:]).astype(np.float)
+        sfacs = parse_sfacs(f"xd.res", sf_num)
         assert len(sfacs) == sf_num, 'Failed to parse Scalefactors!'
         # we need to square the scalefactors (K)
         # Fo**2 = Fc**2 * K**2
@@ -177,112 +264,51 @@ def main():
         # for some reason this scales it -> future problem!
         sfacs /= sfacs.max()
         # fit it
-        popt, pcov = curve_fit(func, bins, sfacs, p0=(0.0,0.0))
+        popt = fit_poly(bins, sfacs)
         # update overall correction factor
         corr_fact += popt
         
-        # read fco data
-        df = pd.DataFrame(np.loadtxt(f"xd.fco", skiprows=26,
-                                     usecols=(0,1,2,3,4,6,7)),
-                          columns=['h','k','l','F2c','F2o','stl','xdr'],
-                          dtype=np.float)
-        # reject unused
-        df.query("xdr == 0", inplace=True)
-        df.drop(['xdr'], axis=1, inplace=True)
-        
-        # read hkl header and data
-        with open(f"xd.hkl") as of:
-            header = of.readline()
-            df_hkl = pd.DataFrame(np.loadtxt(of, usecols=(0,1,2,3,4,5),
-                                             comments='!'),
-                                  columns=['h','k','l','bn','hkl_F2o',
-                                  'hkl_F2s'], dtype=np.float)
-        
-        # merge hkl and fco data (to get sintl)
-        df = pd.merge(df, df_hkl, on=['h','k','l'])
-        # set types
-        df[['h','k','l','bn']] = df[['h','k','l','bn']].astype(np.int8)
+        # the reflections and their sintl do not change between cycles,
+        # only re-read if xd.hkl was changed by someone else
+        if file_sig(f"xd.hkl") != hkl_sig:
+            header, df = read_data(f"xd.fco", f"xd.hkl")
         # apply correction
-        df['hkl_F2o'] = df['hkl_F2o'] / df['stl'].apply(func, 
-                                                        args=(*popt,))
+        apply_correction(df, *popt)
         
-        # write new hkl
-        with open(f"xd.hkl", 'w') as wf:
-            wf.write(header)
-            wf.write(f'!TDS CORRECTION FACTOR: a={popt[0]:.3f}, '
-                     f'b={popt[1]:.3f}\n')
-            df.drop(['F2c','F2o','stl'], axis=1, inplace=True)
-            df.to_string(wf, index=False, header=False,
-                         columns=['h','k','l','bn','hkl_F2o','hkl_F2s'],
-                         formatters=['{:4.0f}'.format,'{:3.0f}'.format,
-                                     '{:3.0f}'.format,'{:1.0f}'.format,
-                                     '{:12f}'.format,'{:12f}'.format])
+        # write new hkl (the copies have to be done)
+        copies.result()
+        write_hkl(f"xd.hkl", header, df, corr_fact=popt)
+        hkl_sig = file_sig(f"xd.hkl")
         
-        # print an info header
-        print(f"\n {'>':>^66}")
-        print(f" >>> {f'Cycle {num} {popt}':^58} >>>")
         # run xdlsm
-        p = Popen(path_xdlsm)
-        p.wait()
+        run_xdlsm(path_xdlsm, f'Cycle {num} {popt}')
 
         # get the next available number
         num = f"{len(glob.glob('xd??.hkl')):>02}"
-        # save copies
-        save_copies(ext_to_save, num)
+        # save copies (in the background)
+        copies = pool.submit(save_copies, ext_to_save, num)
     
     #################################
     ## do 1 scalefactor refinement ##
     ##       with the overall      ##
     ##      correction factor      ##
     #################################
-    # read fco data
-    df = pd.DataFrame(np.loadtxt(f"xd00.fco", skiprows=26,
-                                 usecols=(0,1,2,3,4,6,7)),
-                      columns=['h','k','l','F2c','F2o','stl','xdr'],
-                      dtype=np.float)
-    # reject unused
-    df.query("xdr == 0", inplace=True)
-    df.drop(['xdr'], axis=1, inplace=True)
-    
-    # read hkl header and data
-    with open(f"xd00.hkl") as of:
-        header = of.readline()
-        df_hkl = pd.DataFrame(np.loadtxt(of, usecols=(0,1,2,3,4,5),
-                                         comments='!'),
-                              columns=['h','k','l','bn','hkl_F2o',
-                              'hkl_F2s'], dtype=np.float)
-    
-    # merge hkl and fco data (to get sintl)
-    df = pd.merge(df, df_hkl, on=['h','k','l'])
-    # set types
-    df[['h','k','l','bn']] = df[['h','k','l','bn']].astype(np.int8)
+    # read and merge fco and hkl data
+    header, df = read_data(f"xd00.fco", f"xd00.hkl")
     # apply overall correction
-    df['hkl_F2o'] = df['hkl_F2o'] / df['stl'].apply(func, 
-                                                    args=(*corr_fact,))
+    apply_correction(df, *corr_fact)
     
-    # write new hkl
-    with open(f"xd.hkl", 'w') as wf:
-        wf.write(header)
-        wf.write(f'!TDS CORRECTION FACTOR: a={corr_fact[0]:.3f}, '
-                 f'b={corr_fact[1]:.3f}\n')
-        df.drop(['F2c','F2o','stl'], axis=1, inplace=True)
-        df.to_string(wf, index=False, header=False,
-                    columns=['h','k','l','bn','hkl_F2o','hkl_F2s'],
-                    formatters=['{:4.0f}'.format,'{:3.0f}'.format,
-                                '{:3.0f}'.format,'{:1.0f}'.format,
-                                '{:12f}'.format,'{:12f}'.format])
+    # write new hkl (the copies have to be done)
+    copies.result()
+    pool.shutdown()
+    write_hkl(f"xd.hkl", header, df, corr_fact=corr_fact)
     
     # retrieve original 1 scale refinement
-    shutil.copy(f"xd00.mas", f"xd.mas")
-    shutil.copy(f"xd00.inp", f"xd.inp")
+    copy_file(f"xd00.mas", f"xd.mas")
+    copy_file(f"xd00.inp", f"xd.inp")
     
-    # print an info header
-    print(f"\n {'>':>^66}")
-    print(f" >>> {f'Final 1 Scalefactor Refinement':^58} >>>")
-    print(f" >>> {f'{corr_fact}':^58} >>>")
     # run xdlsm
-    p = Popen(path_xdlsm)
-    p.wait()
+    run_xdlsm(path_xdlsm, 'Final 1 Scalefactor Refinement', f'{corr_fact}')
         
 if __name__ == '__main__':
     main()